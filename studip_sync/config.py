@@ -7,7 +7,8 @@ from studip_sync import get_config_file
 from studip_sync.arg_parser import ARGS
 from studip_sync.config_creator import ConfigCreator
 from studip_sync.constants import URL_BASEURL_DEFAULT, AUTHENTICATION_TYPE_DEFAULT, \
-    AUTHENTICATION_TYPE_DATA_DEFAULT, AUTHENTICATION_TYPES
+    AUTHENTICATION_TYPE_DATA_DEFAULT, AUTHENTICATION_TYPES, PARALLEL_COURSES_DEFAULT, \
+    PARALLEL_DOWNLOADS_DEFAULT
 from studip_sync.helpers import JSONConfig, ConfigError
 
 
@@ -160,6 +161,17 @@ class Config(JSONConfig):
 
         return os.path.expanduser(media_destination)
 
+    @property
+    def workdir_base(self):
+        if not self.config:
+            return None
+
+        workdir_base = self.config.get("workdir_base")
+        if not workdir_base:
+            return None
+
+        return os.path.expanduser(workdir_base)
+
     @property
     def use_new_file_structure(self):
         if not self.config:
@@ -173,6 +185,20 @@ class Config(JSONConfig):
             return []
 
         return self.config.get("ignore_courses", [])
+
+    @property
+    def parallel_courses(self):
+        if not self.config:
+            return PARALLEL_COURSES_DEFAULT
+
+        return self.config.get("parallel_courses") or PARALLEL_COURSES_DEFAULT
+
+    @property
+    def parallel_downloads(self):
+        if not self.config:
+            return PARALLEL_DOWNLOADS_DEFAULT
+
+        return self.config.get("parallel_downloads") or PARALLEL_DOWNLOADS_DEFAULT
     
     @property
     def semester(self):
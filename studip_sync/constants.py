@@ -20,3 +20,5 @@ AUTHENTICATION_TYPES = {"general": GeneralLogin,
 AUTHENTICATION_TYPE_DEFAULT = "general"
 AUTHENTICATION_TYPE_DATA_DEFAULT = {}
 
+PARALLEL_COURSES_DEFAULT = 8
+PARALLEL_DOWNLOADS_DEFAULT = 4
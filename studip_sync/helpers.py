@@ -1,5 +1,14 @@
+import atexit
+import contextlib
+import io
 import json
 import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
 
 
 class ConfigError(Exception):
@@ -32,3 +41,120 @@ class JSONConfig(object):
         with open(path, "w") as config_file:
             print("Writing new config to '{}'".format(path))
             json.dump(config, config_file, ensure_ascii=False, indent=4)
+
+
+class _ThreadLocalOutput(object):
+    """Replacement for sys.stdout which writes to a per-thread buffer if one is set"""
+
+    def __init__(self, stream):
+        super(_ThreadLocalOutput, self).__init__()
+        self.stream = stream
+        self.local = threading.local()
+
+    def _target(self):
+        buffer = getattr(self.local, "buffer", None)
+        return self.stream if buffer is None else buffer
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+_OUTPUT_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def thread_local_output():
+    """Let threads inside this block collect their output with buffered_output()"""
+    stdout = sys.stdout
+    sys.stdout = _ThreadLocalOutput(stdout)
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+
+@contextlib.contextmanager
+def buffered_output():
+    """Collect everything the current thread prints and write it out in one piece at the end"""
+    output = sys.stdout
+    if not isinstance(output, _ThreadLocalOutput):
+        yield
+        return
+
+    buffer = io.StringIO()
+    output.local.buffer = buffer
+    try:
+        yield
+    finally:
+        output.local.buffer = None
+        with _OUTPUT_LOCK:
+            output.stream.write(buffer.getvalue())
+            output.stream.flush()
+
+
+def current_output_buffer():
+    output = sys.stdout
+    if not isinstance(output, _ThreadLocalOutput):
+        return None
+
+    return getattr(output.local, "buffer", None)
+
+
+def share_output_buffer(buffer):
+    """Thread pool initializer to collect the output of worker threads in the given buffer"""
+    output = sys.stdout
+    if buffer is not None and isinstance(output, _ThreadLocalOutput):
+        output.local.buffer = buffer
+
+
+class IgnoreList(object):
+    """Courses to skip, given by course id or by a name pattern with '*' as wildcard"""
+
+    def __init__(self, ignore_courses):
+        super(IgnoreList, self).__init__()
+        self.ids = frozenset(ignore_courses)
+        # Like re.match, the combined pattern only anchors at the start of the name
+        patterns = ["(?:{})".format(ignore.replace('*', '.*')) for ignore in ignore_courses]
+        self.pattern = re.compile("|".join(patterns)) if patterns else None
+
+    def matches(self, course):
+        if course["course_id"] in self.ids:
+            return True
+
+        return self.pattern is not None and self.pattern.match(course["save_as"]) is not None
+
+
+WORKDIR_PREFIX = ".studip-sync"
+# Workdirs of a sync that was killed are removed after this many seconds. Younger ones may belong
+# to a sync which is still running.
+STALE_WORKDIR_AGE = 24 * 60 * 60
+
+
+def remove_stale_workdirs(base_dir):
+    stale_time = time.time() - STALE_WORKDIR_AGE
+
+    with os.scandir(base_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith(WORKDIR_PREFIX) and \
+                    entry.is_dir(follow_symlinks=False) and \
+                    entry.stat(follow_symlinks=False).st_mtime < stale_time:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def make_workdir(*base_dirs):
+    """Create a temporary workdir in the first given base dir or else in the system temp dir"""
+    base_dir = next((base_dir for base_dir in base_dirs if base_dir), tempfile.gettempdir())
+    os.makedirs(base_dir, exist_ok=True)
+    remove_stale_workdirs(base_dir)
+    workdir = tempfile.mkdtemp(prefix=WORKDIR_PREFIX, dir=base_dir)
+
+    # The workdir usually lives inside the synced files, so don't rely on the caller's cleanup
+    atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+
+    return workdir
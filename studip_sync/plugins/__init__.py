@@ -37,6 +37,9 @@ class PluginBase(object):
     def hook_file_download_successful(self, filename, course_save_as, full_filepath):
         pass
 
+    def hook_exit(self):
+        pass
+
     def print(self, message):
         print("[" + self.plugin_name + "] " + message)
 
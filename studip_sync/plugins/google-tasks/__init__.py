@@ -1,6 +1,9 @@
 __all__ = ['Plugin']
 
+import json
 import os.path
+import shutil
+import struct
 import subprocess
 from datetime import timedelta
 
@@ -11,9 +14,12 @@ import pickle
 from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
 
 SCOPES = ['https://www.googleapis.com/auth/tasks']
 DISPLAY_VIDEO_LENGTH_ALLOWED_FILETYPES = ['mp4']
+INSERT_BATCH_SIZE = 50
+FFPROBE = shutil.which("ffprobe") or "ffprobe"
 
 
 class CredentialsError(PermissionError):
@@ -64,34 +70,117 @@ class PluginConfig(JSONConfig):
             pass
 
 
+def _find_box(file, box_type, end):
+    # Returns the end offset of the first box of the given type and leaves the file positioned
+    # behind its header, or None if there is no such box before end
+    while file.tell() + 8 <= end:
+        start = file.tell()
+        size, current_type = struct.unpack(">I4s", file.read(8))
+
+        if size == 1:
+            size = struct.unpack(">Q", file.read(8))[0]
+        elif size == 0:
+            # The box extends to the end of its parent
+            size = end - start
+
+        if size < 8:
+            return None
+
+        if current_type == box_type:
+            return start + size
+
+        file.seek(start + size)
+
+    return None
+
+
+def _mp4_duration(filename):
+    try:
+        with open(filename, "rb") as file:
+            moov_end = _find_box(file, b"moov", os.fstat(file.fileno()).st_size)
+            if moov_end is None or _find_box(file, b"mvhd", moov_end) is None:
+                return None
+
+            version = file.read(4)[0]
+            if version == 1:
+                # Skip 64 bit creation and modification time
+                file.seek(16, os.SEEK_CUR)
+                timescale, duration = struct.unpack(">IQ", file.read(12))
+            else:
+                # Skip 32 bit creation and modification time
+                file.seek(8, os.SEEK_CUR)
+                timescale, duration = struct.unpack(">II", file.read(8))
+    except (OSError, IndexError, struct.error):
+        return None
+
+    if not timescale:
+        return None
+
+    return duration / timescale
+
+
 def get_video_length_of_file(filename):
-    result = subprocess.run(["ffprobe", "-v", "error", "-show_entries",
+    if os.path.splitext(filename)[1][1:].lower() == "mp4":
+        duration = _mp4_duration(filename)
+        if duration is not None:
+            return duration
+
+    result = subprocess.run([FFPROBE, "-v", "error", "-analyzeduration", "1M",
+                             "-probesize", "1M", "-read_intervals", "%+#1", "-show_entries",
                              "format=duration", "-of",
                              "default=noprint_wrappers=1:nokey=1", filename],
                             stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT)
+                            stderr=subprocess.DEVNULL)
     return float(result.stdout)
 
 
 class Plugin(PluginBase):
 
+    _BODY_TEMPLATE = {
+        "status": "needsAction",
+        "kind": "tasks#task",
+        "deleted": False,
+        "hidden": False,
+    }
+
     def __init__(self, config_path):
         super(Plugin, self).__init__("google-tasks", config_path, PluginConfig)
+        self.token_json_path = os.path.join(self.config_dir, "token.json")
         self.token_pickle_path = os.path.join(self.config_dir, "token.pickle")
         self.credentials_path = os.path.join(self.config_dir, "credentials.json")
         self.service = None
+        self._tasks_insert = None
+        self._task_list_id = None
+        self._pending = []
+
+    def load_credentials(self):
+        if os.path.exists(self.token_json_path):
+            with open(self.token_json_path, 'r') as token:
+                return Credentials.from_authorized_user_info(json.load(token), SCOPES)
+
+        # Migrate tokens stored by older versions with pickle
+        if os.path.exists(self.token_pickle_path):
+            with open(self.token_pickle_path, 'rb') as token:
+                credentials = pickle.load(token)
+
+            self.save_credentials(credentials)
+            os.remove(self.token_pickle_path)
+            return credentials
+
+        return None
+
+    def save_credentials(self, credentials):
+        with open(self.token_json_path, 'w') as token:
+            token.write(credentials.to_json())
 
     def hook_configure(self):
         super(Plugin, self).hook_configure()
 
-        credentials = None
-        # The file token.pickle stores the user's access and refresh tokens, and is
+        # The file token.json stores the user's access and refresh tokens, and is
         # created automatically when the authorization flow completes for the first
         # time.
+        credentials = self.load_credentials()
 
-        if os.path.exists(self.token_pickle_path):
-            with open(self.token_pickle_path, 'rb') as token:
-                credentials = pickle.load(token)
         # If there are no (valid) credentials available, let the user log in.
         if not credentials or not credentials.valid:
             if credentials and credentials.expired and credentials.refresh_token:
@@ -104,8 +193,7 @@ class Plugin(PluginBase):
                     self.credentials_path, SCOPES)
                 credentials = flow.run_local_server(port=0)
             # Save the credentials for the next run
-            with open(self.token_pickle_path, 'wb') as token:
-                pickle.dump(credentials, token)
+            self.save_credentials(credentials)
 
         service = build('tasks', 'v1', credentials=credentials)
 
@@ -123,7 +211,8 @@ class Plugin(PluginBase):
 
         task_list_id = input("Please select a task list id to use: ")
 
-        if task_list_id not in [item['id'] for item in items]:
+        task_list_ids = {item['id'] for item in items}
+        if task_list_id not in task_list_ids:
             print("Invalid task id! Please select a task if from the list.")
             return 1
 
@@ -134,11 +223,7 @@ class Plugin(PluginBase):
     def hook_start(self):
         super(Plugin, self).hook_start()
 
-        credentials = None
-
-        if os.path.exists(self.token_pickle_path):
-            with open(self.token_pickle_path, 'rb') as token:
-                credentials = pickle.load(token)
+        credentials = self.load_credentials()
 
         if not credentials or not credentials.valid:
             if credentials and credentials.expired and credentials.refresh_token:
@@ -147,6 +232,8 @@ class Plugin(PluginBase):
                 raise CredentialsError("tasks: couldn't log in")
 
         self.service = build('tasks', 'v1', credentials=credentials)
+        self._tasks_insert = self.service.tasks().insert
+        self._task_list_id = self.config.task_list_id
 
     def hook_file_download_successful(self, filename, course_save_as, full_filepath):
         file_extension = os.path.splitext(filename)[1][1:]
@@ -167,14 +254,33 @@ class Plugin(PluginBase):
         return self.insert_new_task(filename, description)
 
     def insert_new_task(self, title, description):
-        body = {
-            "status": "needsAction",
-            "kind": "tasks#task",
-            "title": title,  # Title of the task.
-            "deleted": False,
-            "notes": description,  # Notes describing the task. Optional.
-            "hidden": False,
-        }
-
-        self.print("Inserting new task: " + title)
-        return self.service.tasks().insert(tasklist=self.config.task_list_id, body=body).execute()
+        # title is the title of the task, notes an optional description
+        body = {**self._BODY_TEMPLATE, "title": title, "notes": description}
+
+        self.print("Queueing new task: " + title)
+        self._pending.append(body)
+
+        if len(self._pending) >= INSERT_BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+
+        def _callback(request_id, response, exception):
+            if exception is not None:
+                self.print("Inserting task failed: " + str(exception))
+
+        self.print("Inserting {} new tasks".format(len(self._pending)))
+
+        batch = self.service.new_batch_http_request(callback=_callback)
+        for body in self._pending:
+            batch.add(self._tasks_insert(tasklist=self._task_list_id, body=body))
+
+        self._pending = []
+        batch.execute()
+
+    def hook_exit(self):
+        super(Plugin, self).hook_exit()
+
+        self._flush()
@@ -1,3 +1,5 @@
+import threading
+
 from studip_sync.plugins.plugin_loader import PluginLoader
 
 
@@ -5,6 +7,8 @@ class PluginList(list):
 
     def __init__(self, plugins=None, config_path=""):
         super(PluginList, self).__init__()
+        # Courses are synced in parallel, but plugins are not expected to be thread-safe
+        self._lock = threading.Lock()
 
         if plugins is None:
             plugins = []
@@ -15,5 +19,6 @@ class PluginList(list):
             self.append(plugin)
 
     def hook(self, hook_name, *args, **kwargs):
-        for plugin in self:
-            getattr(plugin, hook_name)(*args, **kwargs)
+        with self._lock:
+            for plugin in self:
+                getattr(plugin, hook_name)(*args, **kwargs)
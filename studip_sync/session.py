@@ -5,12 +5,15 @@ import urllib.parse
 import json
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from studip_sync import parsers
 from studip_sync.constants import URL_BASEURL_DEFAULT, AUTHENTICATION_TYPES
 from studip_sync.parsers import ParserError
 from studip_sync.plugins.plugin_list import PluginList
 
+DOWNLOAD_BUFFER_SIZE = 1 << 20
+
 
 class SessionError(Exception):
     pass
@@ -32,6 +35,17 @@ class DownloadError(SessionError):
     pass
 
 
+def _write_response(response, path):
+    written_bytes = 0
+
+    with open(path, "wb", buffering=DOWNLOAD_BUFFER_SIZE) as file:
+        for chunk in iter(lambda: response.raw.read(DOWNLOAD_BUFFER_SIZE), b""):
+            file.write(chunk)
+            written_bytes += len(chunk)
+
+    return written_bytes
+
+
 class URL(object):
     def __init__(self, base_url):
         self.base_url = base_url
@@ -78,10 +92,16 @@ class URL(object):
 
 class Session(object):
 
-    def __init__(self, plugins=None, base_url=URL_BASEURL_DEFAULT):
+    def __init__(self, plugins=None, base_url=URL_BASEURL_DEFAULT, pool_maxsize=None):
         super(Session, self).__init__()
         self.session = requests.Session()
         self.session.headers.update({"User-Agent": "WeWantFileSync"})
+
+        if pool_maxsize:
+            # Allow one pooled connection per worker thread sharing this session
+            adapter = HTTPAdapter(pool_maxsize=pool_maxsize)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
         self.url = URL(base_url)
 
         if plugins is None:
@@ -157,8 +177,7 @@ class Session(object):
             if not response.ok:
                 raise DownloadError("Cannot download file")
 
-            with open(tempfile, "wb") as file:
-                shutil.copyfileobj(response.raw, file)
+            return _write_response(response, tempfile)
 
     def download_file_api(self, file_id, tempfile):
         download_url = self.url.files_api_download(file_id)
@@ -168,8 +187,7 @@ class Session(object):
                 print(response.text)
                 raise DownloadError("Cannot download file")
 
-            with open(tempfile, "wb") as file:
-                shutil.copyfileobj(response.raw, file)
+            return _write_response(response, tempfile)
 
     def get_files_index(self, course_id, folder_id=None):
         params = {"cid": course_id}
@@ -1,14 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from functools import lru_cache
+import errno
 import os
 import shutil
-import tempfile
+import threading
 import time
 import unicodedata
-import string
 import re
 
 from studip_sync.arg_parser import ARGS
 from studip_sync.config import CONFIG
+from studip_sync.helpers import IgnoreList, buffered_output, current_output_buffer, \
+    make_workdir, share_output_buffer, thread_local_output
 from studip_sync.logins import LoginError
 from studip_sync.plugins.plugins import PLUGINS
 from studip_sync.session import Session, DownloadError, MissingFeatureError, \
@@ -20,20 +24,32 @@ class StudIPRSync(object):
 
     def __init__(self):
         super(StudIPRSync, self).__init__()
-        self.workdir = tempfile.mkdtemp(prefix="studip-sync")
         self.files_destination_dir = CONFIG.files_destination
         self.media_destination_dir = CONFIG.media_destination
-        self.ignore_courses = CONFIG.ignore_courses
 
         if self.files_destination_dir:
             os.makedirs(self.files_destination_dir, exist_ok=True)
         if self.media_destination_dir:
             os.makedirs(self.media_destination_dir, exist_ok=True)
 
+        # Prefer a workdir next to the synced files, so downloads stay on the same filesystem
+        self.workdir = make_workdir(CONFIG.workdir_base, self.files_destination_dir)
+        self.ignore_courses = CONFIG.ignore_courses
+        self._ignore_list = IgnoreList(self.ignore_courses)
+        self.parallel_courses = CONFIG.parallel_courses
+
+        self._same_fs = False
+
+        if self.files_destination_dir:
+            # Downloaded files can be renamed instead of copied if both are on the same device
+            self._same_fs = os.stat(self.workdir).st_dev == \
+                os.stat(self.files_destination_dir).st_dev
+
     def sync(self, sync_fully=False, sync_recent=False, use_api=True):
         PLUGINS.hook("hook_start")
 
-        with Session(base_url=CONFIG.base_url, plugins=PLUGINS) as session:
+        with Session(base_url=CONFIG.base_url, plugins=PLUGINS,
+                     pool_maxsize=self.parallel_courses * CONFIG.parallel_downloads) as session:
             print("Logging in...")
             try:
                 session.login(CONFIG.auth_type, CONFIG.auth_type_data, CONFIG.username,
@@ -58,67 +74,40 @@ class StudIPRSync(object):
 
             print("Downloading course list...")
 
-            try:
-                courses = list(session.get_courses(sync_recent))
-            except (LoginError, ParserError) as e:
-                print("Downloading course list failed!")
-                print(e)
-                return 1
+            # Courses are parsed lazily and handed to the pool as soon as they are available
+            courses = session.get_courses(sync_recent)
 
             if sync_recent:
                 print("Syncing only the most recent semester!")
 
             status_code = 0
-            for i in range(0, len(courses)):
-                course = courses[i]
-                if course["course_id"] in self.ignore_courses or \
-                    any(re.match(ignore.replace('*', '.*'), course["save_as"]) for ignore in self.ignore_courses):
-                    print(f"Skipping course \"{course['save_as']}\" as it is in the ignore list.")
-                    continue
-                print("{}) {}: {}".format(i + 1, course["semester"], course["save_as"]))
-
-                course_save_as = get_course_save_as(course)
-
-                if self.files_destination_dir:
-                    try:
-                        files_root_dir = os.path.join(self.files_destination_dir, course_save_as)
-
-                        CourseRSync(session, self.workdir, files_root_dir, course,
-                                    sync_fully, use_api).download()
-                    except MissingFeatureError:
-                        # Ignore if there are no files
-                        pass
-                    except DownloadError as e:
-                        print("\tDownload of files failed: " + str(e))
-                        status_code = 2
-                        raise e
-
-                if self.media_destination_dir:
-                    try:
-                        print("\tSyncing media files...")
-
-                        media_root_dir = os.path.join(self.media_destination_dir,
-                                                      course_save_as)
-
-                        session.download_media(course["course_id"], media_root_dir,
-                                               course["save_as"])
-                    except MissingFeatureError:
-                        # Ignore if there is no media
-                        pass
-                    except MissingPermissionFolderError:
-                        # Ignore if there are no permissions
-                        pass
-                    except DownloadError as e:
-                        print("\tDownload of media failed: " + str(e))
-                        status_code = 2
-                        raise e
-                    except ParserError as e:
-                        print("\tDownload of media failed: " + str(e))
-                        if status_code != 0:
-                            raise e
-                        else:
-                            status_code = 2
-            
+            with thread_local_output(), \
+                    ThreadPoolExecutor(max_workers=self.parallel_courses) as executor:
+                futures = {}
+                try:
+                    for i, course in enumerate(courses):
+                        if self._ignore_list.matches(course):
+                            print(f"Skipping course \"{course['save_as']}\" as it is in the ignore list.")
+                            continue
+
+                        future = executor.submit(self._sync_one_course, i + 1, session, course,
+                                                 sync_fully, use_api)
+                        futures[future] = course
+                except (LoginError, ParserError) as e:
+                    print("Downloading course list failed!")
+                    print(e)
+                    for pending in futures:
+                        pending.cancel()
+                    return 1
+
+                try:
+                    for future in as_completed(futures):
+                        status_code = max(status_code, future.result())
+                except BaseException:
+                    # Stop at the first error (or Ctrl-C) instead of syncing the queued courses
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+
             print("Changing semester visibility back to current...")
             session.set_semester("current")
 
@@ -127,6 +116,51 @@ class StudIPRSync(object):
 
         return status_code
 
+    def _sync_one_course(self, number, session, course, sync_fully, use_api):
+        # Courses run in parallel, so print each course's output as one block once it is done
+        with buffered_output():
+            print("{}) {}: {}".format(number, course["semester"], course["save_as"]))
+            return self._sync_course(session, course, sync_fully, use_api)
+
+    def _sync_course(self, session, course, sync_fully, use_api):
+        status_code = 0
+        course_save_as = get_course_save_as(course)
+
+        if self.files_destination_dir:
+            try:
+                files_root_dir = os.path.join(self.files_destination_dir, course_save_as)
+
+                CourseRSync(session, self.workdir, files_root_dir, course,
+                            sync_fully, use_api, self._same_fs).download()
+            except MissingFeatureError:
+                # Ignore if there are no files
+                pass
+            except DownloadError as e:
+                print("\tDownload of files failed: " + str(e))
+                raise e
+
+        if self.media_destination_dir:
+            try:
+                print("\tSyncing media files...")
+
+                media_root_dir = os.path.join(self.media_destination_dir, course_save_as)
+
+                session.download_media(course["course_id"], media_root_dir, course["save_as"])
+            except MissingFeatureError:
+                # Ignore if there is no media
+                pass
+            except MissingPermissionFolderError:
+                # Ignore if there are no permissions
+                pass
+            except DownloadError as e:
+                print("\tDownload of media failed: " + str(e))
+                raise e
+            except ParserError as e:
+                print("\tDownload of media failed: " + str(e))
+                status_code = 2
+
+        return status_code
+
     def cleanup(self):
         shutil.rmtree(self.workdir)
 
@@ -134,21 +168,34 @@ class StudIPRSync(object):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.cleanup()
+        try:
+            PLUGINS.hook("hook_exit")
+        finally:
+            self.cleanup()
 
 
 UNICODE_NORMALIZE_MODE = "NFKC"
+_CLEAN_RE = re.compile(r'[\\:*?"<>|]')
+# pattern: <number> <type letter> <course name (max 2)> <optional digit>
+_SHORT_RE = re.compile(r'(\d+)\s([A-ZÄÖÜ])\S*\s(([A-Z]+[a-zäöüß]* ?){1,2})\D*(\d?).*')
+_HEX_RE = re.compile(r'\A[0-9a-fA-F]+\Z').match
 
+@lru_cache(maxsize=8192)
 def clean_name(name):
     # Remove all disallowed characters for Windows, Mac and Linux
-    return re.sub(r'[\\:*?"<>|]', '', name.replace("/", "--")).strip()
+    # (str.translate is only faster for pure ASCII names and a lot slower for names with umlauts)
+    return _CLEAN_RE.sub('', name.replace("/", "--")).strip()
+
+@lru_cache(maxsize=8192)
+def clean_file_name(name):
+    # Only used for file and folder names, course and semester paths must stay as they are
+    return clean_name(unicodedata.normalize(UNICODE_NORMALIZE_MODE, name))
 
+@lru_cache(maxsize=8192)
 def short_course_name(name):
     # Remove all non-alphanumeric symbols
     #clean_name = re.sub(r'[^a-zA-ZÄÖÜ0-9\s]', '', name)
-    # pattern: <number> <type letter> <course name (max 2)> <optional digit>
-    pattern = re.compile(r'(\d+)\s([A-ZÄÖÜ])\S*\s(([A-Z]+[a-zäöüß]* ?){1,2})\D*(\d?).*')
-    match = pattern.match(clean_name(name))
+    match = _SHORT_RE.match(clean_name(name))
     if match:
         res = f"{match.group(1)} {match.group(2)} {match.group(3)}{match.group(5)}".strip()
         print("Result: "+res)
@@ -166,7 +213,7 @@ def check_and_cleanup_form_data(form_data_files, form_data_folders, use_api):
                 
             form_id = form_data["id"]
             
-            if not all(c in string.hexdigits for c in form_id):
+            if not _HEX_RE(form_id):
                 raise ParserError("id is not hexadecimal")
 
             # TODO: support links by saving them as .url files
@@ -181,7 +228,7 @@ def check_and_cleanup_form_data(form_data_files, form_data_folders, use_api):
                 continue
 
             new_file_data = {
-                "name": clean_name(unicodedata.normalize(UNICODE_NORMALIZE_MODE, form_data["name"])),
+                "name": clean_file_name(form_data["name"]),
                 "id": form_id,
                 "size": int(form_data["size"]),
                 "chdate": int(form_data["chdate"])
@@ -202,11 +249,11 @@ def check_and_cleanup_form_data(form_data_files, form_data_folders, use_api):
                 log("Skipped folder that can't be downloaded")
                 continue
             form_id = form_data["id"]
-            if not all(c in string.hexdigits for c in form_id):
+            if not _HEX_RE(form_id):
                 raise ValueError("id is not hexadecimal")
 
             form_data_folders_new.append({
-                "name": clean_name(unicodedata.normalize(UNICODE_NORMALIZE_MODE, form_data["name"])),
+                "name": clean_file_name(form_data["name"]),
                 "id": form_id
             })
         except Exception as e:
@@ -228,19 +275,20 @@ def is_file_new(file, file_path):
         # If there is no size, skip this file, since it cant be downloaded
         return False
 
-
-    if not os.path.exists(file_path):
+    try:
+        file_stat = os.stat(file_path)
+    except FileNotFoundError:
         log("File changed: new: {}".format(file_path))
         return True
 
-    file_time = int(os.path.getmtime(file_path))
+    file_time = int(file_stat.st_mtime)
 
     chdate = file["chdate"]
     if chdate > file_time:
         log("File changed: time: {} - {} : {}".format(chdate, file_time, file_path))
         return True
 
-    file_size = os.path.getsize(file_path)
+    file_size = file_stat.st_size
 
     size = file["size"]
     if not size == file_size:
@@ -262,9 +310,13 @@ def get_course_save_as(course):
 
 class CourseRSync:
 
-    def __init__(self, session, workdir, root_folder, course, sync_fully, use_api):
+    _move_lock = threading.Lock()
+
+    def __init__(self, session, workdir, root_folder, course, sync_fully, use_api,
+                 same_fs=False):
         self.session = session
         self.workdir = workdir
+        self.same_fs = same_fs
         self.course_id = course["course_id"]
         self.course_save_as = course["save_as"]
         self.root_folder = root_folder
@@ -284,64 +336,122 @@ class CourseRSync:
 
         return self.session.check_course_new_files(self.course_id, CONFIG.last_sync)
 
-    def download_recursive(self, folder_id=None, folder_path_relative=""):
-        try:
-            if self.use_api:
-                form_data_files, form_data_folders = self.session.get_files_index_from_api(self.course_id,
-                                                                              folder_id)
-            else:
-                form_data_files, form_data_folders = self.session.get_files_index(self.course_id,
-                                                                              folder_id)
-        except MissingPermissionFolderError:
-            log("Couldn't view the following folder because of missing permissions: " + folder_path_relative)
-            return
-
-        form_data_files, form_data_folders = check_and_cleanup_form_data(form_data_files,
-                                                                         form_data_folders, self.use_api)
-
-        for file_data in form_data_files:
-            if file_data["download_url"] is None:
-                log("Skipped file that can't be downloaded: {}".format(file_data["name"]))
-                continue
-            folder_absolute = os.path.join(self.root_folder, folder_path_relative)
-            file_path = os.path.join(folder_absolute, file_data["name"])
-            if is_file_new(file_data, file_path):
-                log("Downloading: {}: {}".format(file_data["id"], file_data["name"]))
+    def download_recursive(self):
+        # The workers print into the output buffer of this course
+        with ThreadPoolExecutor(max_workers=CONFIG.parallel_downloads,
+                                initializer=share_output_buffer,
+                                initargs=(current_output_buffer(),)) as executor:
+            downloads = self._collect_downloads(executor)
 
-                target_file = os.path.join(self.workdir, file_data["id"])
+            # Fetch all files concurrently, but move them into place on this thread
+            futures = [executor.submit(self._download_file, download) for download in downloads]
+            try:
+                for future in futures:
+                    self._move_into_place(*future.result())
+            except Exception:
+                for pending in futures:
+                    pending.cancel()
+                raise
+
+    def _get_files_index(self, folder_id):
+        if self.use_api:
+            return self.session.get_files_index_from_api(self.course_id, folder_id)
+        else:
+            return self.session.get_files_index(self.course_id, folder_id)
+
+    def _collect_downloads(self, executor):
+        downloads = []
+
+        # Walk the folder tree level by level and fetch the indexes of each level concurrently
+        pending = [(None, "")]
+        while pending:
+            futures = [(executor.submit(self._get_files_index, folder_id), folder_path_relative)
+                       for folder_id, folder_path_relative in pending]
+            pending = []
+
+            for future, folder_path_relative in futures:
+                try:
+                    form_data_files, form_data_folders = future.result()
+                except MissingPermissionFolderError:
+                    log("Couldn't view the following folder because of missing permissions: " + folder_path_relative)
+                    continue
 
-                if not self.use_api:
-                    self.session.download_file(file_data["download_url"], target_file)
-                else:
-                    self.session.download_file_api(file_data["id"], target_file)
-
-                file_size = int(file_data["size"])
-                target_file_size = os.path.getsize(target_file)
-                if target_file_size != file_size:
-                    if ARGS.v:
-                        print("[Debug] " + str(form_data_files))
-                    raise DownloadError("File size didn't match expected file size: " + file_path)
-
-                file_path_base, file_path_name = os.path.split(file_path)
-                if os.path.exists(file_path):
-                    timestr = datetime.strftime(datetime.now(), "%Y-%m-%d_%H+%M+%S")
-                    suffix = "_" + timestr + ".old"
-                    new_file_path = os.path.join(file_path_base, file_path_name + suffix)
-                    os.rename(file_path, new_file_path)
-                else:
-                    os.makedirs(file_path_base, exist_ok=True)
+                form_data_files, form_data_folders = check_and_cleanup_form_data(form_data_files,
+                                                                                 form_data_folders, self.use_api)
+
+                for file_data in form_data_files:
+                    if not self.use_api and file_data["download_url"] is None:
+                        log("Skipped file that can't be downloaded: {}".format(file_data["name"]))
+                        continue
+                    folder_absolute = os.path.join(self.root_folder, folder_path_relative)
+                    file_path = os.path.join(folder_absolute, file_data["name"])
+                    if is_file_new(file_data, file_path):
+                        target_file = os.path.join(self.workdir, file_data["id"])
+                        downloads.append((file_data, target_file, file_path))
 
-                if os.path.exists(file_path):
-                    raise DownloadError("File exists already, even after moving it away: " +
-                                        file_path)
+                for folder_data in form_data_folders:
+                    new_folder_path_relative = os.path.join(folder_path_relative, folder_data["name"])
+                    pending.append((folder_data["id"], new_folder_path_relative))
 
-                shutil.copyfile(target_file, file_path)
+        return downloads
 
-                self.session.plugins.hook("hook_file_download_successful", file_data["name"],
-                                          self.course_save_as, file_path)
+    def _download_file(self, download):
+        file_data, target_file, file_path = download
 
-        for folder_data in form_data_folders:
-            new_folder_path_relative = os.path.join(folder_path_relative, folder_data["name"])
+        log("Downloading: {}: {}".format(file_data["id"], file_data["name"]))
 
-            # self.log("Accessing folder: " + folder_data["id"] + ": " + folder_data["name"])
-            self.download_recursive(folder_data["id"], new_folder_path_relative)
+        if not self.use_api:
+            written_bytes = self.session.download_file(file_data["download_url"], target_file)
+        else:
+            written_bytes = self.session.download_file_api(file_data["id"], target_file)
+
+        file_size = int(file_data["size"])
+        if written_bytes != file_size:
+            if ARGS.v:
+                print("[Debug] " + str(file_data))
+            raise DownloadError("File size didn't match expected file size: " + file_path)
+
+        return download
+
+    def _move_into_place(self, file_data, target_file, file_path):
+        # Courses with colliding short names share their root folder and are synced in parallel
+        with CourseRSync._move_lock:
+            self._replace_file(target_file, file_path)
+
+        self.session.plugins.hook("hook_file_download_successful", file_data["name"],
+                                  self.course_save_as, file_path)
+
+    def _replace_file(self, target_file, file_path):
+        file_path_base, file_path_name = os.path.split(file_path)
+        timestr = datetime.strftime(datetime.now(), "%Y-%m-%d_%H+%M+%S")
+        new_file_path = os.path.join(file_path_base, file_path_name + "_" + timestr + ".old")
+
+        # Don't overwrite a backup made earlier in the same second
+        counter = 1
+        while os.path.lexists(new_file_path):
+            counter += 1
+            new_file_path = os.path.join(file_path_base, "{}_{}_{}.old".format(
+                file_path_name, timestr, counter))
+
+        try:
+            os.rename(file_path, new_file_path)
+        except FileNotFoundError:
+            os.makedirs(file_path_base, exist_ok=True)
+
+        if os.path.exists(file_path):
+            raise DownloadError("File exists already, even after moving it away: " +
+                                file_path)
+
+        moved = False
+        if self.same_fs:
+            try:
+                os.replace(target_file, file_path)
+                moved = True
+            except OSError as e:
+                # The course folder may be a mount point or a symlink to another filesystem
+                if e.errno != errno.EXDEV:
+                    raise
+
+        if not moved:
+            # copyfile already uses sendfile/fcopyfile where the platform supports it
+            shutil.copyfile(target_file, file_path)
@@ -1,14 +1,17 @@
+import filecmp
 import shutil
 import os
-import tempfile
+import threading
 import zipfile
-import glob
-import subprocess
 import time
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from functools import lru_cache
 
 from studip_sync.config import CONFIG
+from studip_sync.helpers import IgnoreList, buffered_output, make_workdir, \
+    thread_local_output
 from studip_sync.logins import LoginError
 from studip_sync.plugins.plugins import PLUGINS
 from studip_sync.session import Session, DownloadError, MissingFeatureError, \
@@ -24,27 +27,32 @@ class StudipSync(object):
 
     def __init__(self):
         super(StudipSync, self).__init__()
-        self.workdir = tempfile.mkdtemp(prefix="studip-sync")
-        self.download_dir = os.path.join(self.workdir, "zips")
-        self.extract_dir = os.path.join(self.workdir, "extracted")
         self.files_destination_dir = CONFIG.files_destination
         self.media_destination_dir = CONFIG.media_destination
-        self.ignore_courses = CONFIG.ignore_courses
 
-        os.makedirs(self.download_dir)
-        os.makedirs(self.extract_dir)
         if self.files_destination_dir:
             os.makedirs(self.files_destination_dir, exist_ok=True)
         if self.media_destination_dir:
             os.makedirs(self.media_destination_dir, exist_ok=True)
 
+        # The extracted files are copied anyway, so keep the zips out of the destination
+        self.workdir = make_workdir(CONFIG.workdir_base)
+        self.download_dir = os.path.join(self.workdir, "zips")
+        self.extract_dir = os.path.join(self.workdir, "extracted")
+        self.ignore_courses = CONFIG.ignore_courses
+        self._ignore_list = IgnoreList(self.ignore_courses)
+        self.parallel_courses = CONFIG.parallel_courses
+
+        os.makedirs(self.download_dir)
+        os.makedirs(self.extract_dir)
+
     def sync(self, sync_fully=False, sync_recent=False):
         PLUGINS.hook("hook_start")
 
         extractor = Extractor(self.extract_dir)
-        rsync = RsyncWrapper()
 
-        with Session(base_url=CONFIG.base_url, plugins=PLUGINS) as session:
+        with Session(base_url=CONFIG.base_url, plugins=PLUGINS,
+                     pool_maxsize=self.parallel_courses) as session:
             print("Logging in...")
             try:
                 session.login(CONFIG.auth_type, CONFIG.auth_type_data, CONFIG.username,
@@ -80,69 +88,128 @@ class StudipSync(object):
                 print("Syncing only the most recent semester!")
 
             status_code = 0
-            for i in range(0, len(courses)):
-                course = courses[i]
-                course["save_as"] = short_course_name(course["save_as"])
-                if course["course_id"] in self.ignore_courses or \
-                    any(re.match(ignore.replace('*', '.*'), course["save_as"]) for ignore in self.ignore_courses):
-                    print(f"Skipping course \"{course['save_as']}\" as it is in the ignore list.")
-                    continue
-                print("{}) {}: {}".format(i+1, course["semester"], course["save_as"]))
-
-                if self.files_destination_dir:
-                    try:
-                        if sync_fully or session.check_course_new_files(course["course_id"], CONFIG.last_sync):
-                            print("\tDownloading files...")
-                            zip_location = session.download(
-                                course["course_id"], self.download_dir, course.get("sync_only"))
-                            extractor.extract(zip_location, course["save_as"])
-                        else:
-                            print("\tSkipping this course...")
-                    except MissingFeatureError:
-                        # Ignore if there are no files
-                        pass
-                    except DownloadError as e:
-                        print("\tDownload of files failed: " + str(e))
-                        status_code = 2
-                    except ExtractionError as e:
-                        print("\tExtracting files failed: " + str(e))
-                        status_code = 2
-
-                if self.media_destination_dir:
-                    try:
-                        print("\tSyncing media files...")
-
-                        media_course_dir = os.path.join(self.media_destination_dir, course["save_as"])
-
-                        session.download_media(course["course_id"], media_course_dir, course["save_as"])
-                    except MissingFeatureError:
-                        # Ignore if there is no media
-                        pass
-                    except MissingPermissionFolderError:
-                        # Ignore if there are no permissions
-                        pass
-                    except DownloadError as e:
-                        print("\tDownload of media failed: " + str(e))
-                        status_code = 2
-                    except ParserError as e:
-                        print("\tDownload of media failed: " + str(e))
-                        if status_code != 0:
-                            raise e
-                        else:
-                            status_code = 2
-            
+            with thread_local_output(), \
+                    ThreadPoolExecutor(max_workers=self.parallel_courses) as executor:
+                futures = {}
+                for i, course in enumerate(courses):
+                    course["save_as"] = short_course_name(course["save_as"])
+                    if self._ignore_list.matches(course):
+                        print(f"Skipping course \"{course['save_as']}\" as it is in the ignore list.")
+                        continue
+
+                    future = executor.submit(self._sync_one_course, i + 1, session, extractor, course,
+                                             sync_fully)
+                    futures[future] = course
+
+                try:
+                    for future in as_completed(futures):
+                        status_code = max(status_code, future.result())
+                except BaseException:
+                    # Stop at the first error (or Ctrl-C) instead of syncing the queued courses
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+
             print("Changing semester visibility back to current...")
             session.set_semester("current")
 
         if self.files_destination_dir:
             print("Synchronizing with existing files...")
-            rsync.sync(self.extract_dir + "/", self.files_destination_dir)
+            timestr = datetime.strftime(datetime.now(), "%Y-%m-%d_%H+%M+%S")
+            self._sync_tree(self.extract_dir, self.files_destination_dir, "_" + timestr + ".old")
 
             if status_code == 0:
                 CONFIG.update_last_sync(int(time.time()))
 
         return status_code
 
+    def _sync_one_course(self, number, session, extractor, course, sync_fully):
+        # Courses run in parallel, so print each course's output as one block once it is done
+        with buffered_output():
+            print("{}) {}: {}".format(number, course["semester"], course["save_as"]))
+            return self._sync_course(session, extractor, course, sync_fully)
+
+    def _sync_course(self, session, extractor, course, sync_fully):
+        status_code = 0
+
+        if self.files_destination_dir:
+            try:
+                if sync_fully or session.check_course_new_files(course["course_id"], CONFIG.last_sync):
+                    print("\tDownloading files...")
+                    zip_location = session.download(
+                        course["course_id"], self.download_dir, course.get("sync_only"))
+                    extractor.extract(zip_location, course["save_as"])
+                else:
+                    print("\tSkipping this course...")
+            except MissingFeatureError:
+                # Ignore if there are no files
+                pass
+            except DownloadError as e:
+                print("\tDownload of files failed: " + str(e))
+                status_code = 2
+            except ExtractionError as e:
+                print("\tExtracting files failed: " + str(e))
+                status_code = 2
+
+        if self.media_destination_dir:
+            try:
+                print("\tSyncing media files...")
+
+                media_course_dir = os.path.join(self.media_destination_dir, course["save_as"])
+
+                session.download_media(course["course_id"], media_course_dir, course["save_as"])
+            except MissingFeatureError:
+                # Ignore if there is no media
+                pass
+            except MissingPermissionFolderError:
+                # Ignore if there are no permissions
+                pass
+            except DownloadError as e:
+                print("\tDownload of media failed: " + str(e))
+                status_code = 2
+            except ParserError as e:
+                print("\tDownload of media failed: " + str(e))
+                status_code = 2
+
+        return status_code
+
+    def _sync_tree(self, source, destination, backup_suffix):
+        try:
+            os.makedirs(destination, exist_ok=True)
+        except FileExistsError:
+            # A file is in the way of this directory, back it up like a changed file
+            os.rename(destination, destination + backup_suffix)
+            os.makedirs(destination)
+
+        with os.scandir(source) as entries:
+            for entry in entries:
+                destination_path = os.path.join(destination, entry.name)
+
+                if entry.is_dir(follow_symlinks=False):
+                    self._sync_tree(entry.path, destination_path, backup_suffix)
+                    continue
+
+                try:
+                    destination_stat = os.stat(destination_path)
+                except FileNotFoundError:
+                    pass
+                else:
+                    source_stat = entry.stat()
+                    if destination_stat.st_size == source_stat.st_size:
+                        if destination_stat.st_mtime_ns == source_stat.st_mtime_ns:
+                            continue
+
+                        # Files copied by older versions don't carry the Stud.IP mtime yet, so
+                        # compare them once and take over the mtime if they are equal
+                        if filecmp.cmp(entry.path, destination_path, shallow=False):
+                            os.utime(destination_path, ns=(destination_stat.st_atime_ns,
+                                                           source_stat.st_mtime_ns))
+                            continue
+
+                    os.rename(destination_path, destination_path + backup_suffix)
+
+                print(destination_path)
+                shutil.copy2(entry.path, destination_path)
+
     def cleanup(self):
         shutil.rmtree(self.workdir)
 
@@ -150,75 +217,70 @@ class StudipSync(object):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.cleanup()
+        try:
+            PLUGINS.hook("hook_exit")
+        finally:
+            self.cleanup()
+
+_CLEAN_RE = re.compile(r'[\\:*?"<>|]')
+# pattern: <number> <type letter> <course name (max 2)> <optional digit>
+_SHORT_RE = re.compile(r'(\d+)\s([A-ZÄÖÜ])\S*\s(([A-Z]+[a-zäöüß]* ?){1,2})\D*(\d?).*')
 
+@lru_cache(maxsize=8192)
 def clean_name(name):
     # Remove all disallowed characters for Windows, Mac and Linux
-    return re.sub(r'[\\:*?"<>|]', '', name.replace("/", "--")).strip()
+    return _CLEAN_RE.sub('', name.replace("/", "--")).strip()
 
+@lru_cache(maxsize=8192)
 def short_course_name(name):
     # Remove all non-alphanumeric symbols
     #clean_name = re.sub(r'[^a-zA-ZÄÖÜ0-9\s]', '', name)
-    # pattern: <number> <type letter> <course name (max 2)> <optional digit>
-    pattern = re.compile(r'(\d+)\s([A-ZÄÖÜ])\S*\s(([A-Z]+[a-zäöüß]* ?){1,2})\D*(\d?).*')
-    match = pattern.match(clean_name(name))
+    match = _SHORT_RE.match(clean_name(name))
     if match:
         return f"{match.group(1)} {match.group(2)} {match.group(3)}{match.group(5)}".strip()
     else:
         return False
 
-# pylint: disable=too-few-public-methods
-class RsyncWrapper(object):
-
-    def __init__(self):
-        super(RsyncWrapper, self).__init__()
-        timestr = datetime.strftime(datetime.now(), "%Y-%m-%d_%H+%M+%S")
-        self.suffix = "_" + timestr + ".old"
-
-    def sync(self, source, destination):
-        subprocess.call(["rsync", "--recursive", "--checksum", "--backup", "-v",
-                         "--suffix=" + self.suffix, source, destination])
-
-
 class Extractor(object):
 
     def __init__(self, basedir):
         super(Extractor, self).__init__()
         self.basedir = basedir
+        # Courses are synced in parallel and their short names may collide, so only extract one
+        # archive at a time
+        self._lock = threading.Lock()
 
     @staticmethod
-    def remove_intermediary_dir(extracted_dir):
-        def _filter_dirs(base_name):
-            return os.path.isdir(os.path.join(extracted_dir, base_name))
-
-        subdirs = list(filter(_filter_dirs, os.listdir(extracted_dir)))
-        if len(subdirs) == 1:
-            intermediary = os.path.join(extracted_dir, subdirs[0])
-            for filename in glob.iglob(os.path.join(intermediary, "*")):
-                shutil.move(filename, extracted_dir)
-            os.rmdir(intermediary)
-
-    @staticmethod
-    def remove_empty_dirs(directory):
-        for root, dirs, files in os.walk(directory):
-            if not dirs and not files:
-                os.rmdir(root)
+    def intermediary_prefix(names):
+        top_dirs = {name.split("/", 1)[0] for name in names if "/" in name}
+        if len(top_dirs) == 1:
+            return top_dirs.pop() + "/"
 
-    @staticmethod
-    def remove_filelist(directory):
-        filelist = os.path.join(directory, "archive_filelist.csv")
-        if os.path.isfile(filelist):
-            os.remove(filelist)
+        return ""
 
     def extract(self, archive_filename, destination, cleanup=True):
         try:
-            with zipfile.ZipFile(archive_filename, "r") as archive:
+            with self._lock, zipfile.ZipFile(archive_filename, "r") as archive:
                 destination = os.path.join(self.basedir, destination)
-                archive.extractall(destination)
-                if cleanup:
-                    self.remove_filelist(destination)
-                    self.remove_intermediary_dir(destination)
-                    self.remove_empty_dirs(destination)
+
+                # Strip the intermediary dir and skip the filelist and (empty) dir entries while
+                # extracting, so the tree doesn't need to be walked afterwards
+                prefix = self.intermediary_prefix(archive.namelist()) if cleanup else ""
+                for member in archive.infolist():
+                    if cleanup:
+                        if member.filename == "archive_filelist.csv" or member.is_dir():
+                            continue
+
+                        if prefix and member.filename.startswith(prefix):
+                            member.filename = member.filename[len(prefix):]
+
+                    path = archive.extract(member, destination)
+
+                    if not member.is_dir():
+                        # Keep the modification time from Stud.IP, so the tree sync can skip
+                        # unchanged files without comparing their contents
+                        mtime = time.mktime(member.date_time + (0, 0, -1))
+                        os.utime(path, (mtime, mtime))
 
                 return destination
         except zipfile.BadZipFile: